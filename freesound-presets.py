@@ -5,11 +5,13 @@ import re
 import json
 import time
 
+from concurrent.futures import ProcessPoolExecutor
+
 import freesound
 
 from api_key import API_KEY
-from argparse import ArgumentParser
-from helpers import DownloadAndConvertSoundsThread, SourceExporter, BlackboxExporter
+from argparse import ArgumentParser, Namespace
+from helpers import pcm_codecs, AudioProcessingSettings, download_and_convert_sound, get_sound_cache_path, get_worker_id, InstrumentSoundsSelector, JobLeaseRenewalThread, JobQueue, SoundsBudgetPlanner, SourceExporter, BlackboxExporter
 
 
 logger = logging.getLogger()
@@ -19,6 +21,7 @@ freesound_client.set_token(API_KEY)
 
 available_preset_types = ['instrument', '16pad', 'loops']
 available_exporters = ['source', 'blackbox']
+max_sound_length_per_preset_type = {'instrument': 10.0, '16pad': 2.0, 'loops': None}  # In seconds, applied when trimming sounds
 
 
 def note_name_to_number(note_name):
@@ -128,169 +131,200 @@ def get_effective_start_time(sound):
     return 0
 
 
-def prepare_sound(sound, use_original=False, use_converted=False):
+def prepare_sound(sound, use_original=False, use_converted=False, processing=None):
     logger.debug('- Preparing sound {}'.format(sound.id)) 
     data = {}
 
-    if use_converted:
-        path = 'audio/{}.wav'.format(sound.id)
-    else:
-        if use_original:
-            path = '/app/audio/{}.{}'.format(sound.id, sound.type)
-        else:
-            path = '/app/audio/{}.ogg'.format(sound.id)
-
-    data['path'] = path
+    data['path'] = get_sound_cache_path(sound.id, sound.type if use_original else 'ogg', convert=use_converted, processing=processing, original=use_original)
     data['id'] = sound.id
     data['type'] = sound.type
     data['filesize'] = sound.filesize
     data['name'] = sound.name
     data['license'] = sound.license    
     data['preview_url'] = sound.previews.preview_hq_ogg
+    data['download_url'] = 'https://freesound.org/apiv2/sounds/{}/download/'.format(sound.id)
     data['username'] = sound.username
     data['duration'] = float(sound.duration)
     data['start_time'] = get_effective_start_time(sound)
     data['start_percentage'] = data['start_time'] / data['duration']
     data['midi_note'] = get_midi_note(sound)
     data['midi_velocity'] = get_midi_velocity(sound)
+    data['channels'] = getattr(sound, 'channels', None)
+    data['source_samplerate'] = getattr(sound, 'samplerate', None)
+    data['bitdepth'] = getattr(sound, 'bitdepth', None)
+    data['use_original'] = use_original
+    if use_converted and processing is not None:
+        data['samplerate'] = processing.samplerate
     return {key: value for key, value in data.items() if value is not None}
 
-def download_sounds(sounds, use_converted_files):
-    for sound in sounds:
-        logger.debug('{}'.format(sound['id']))
-        dw_thread = DownloadAndConvertSoundsThread(sound['preview_url'], sound['id'], convert=use_converted_files)
-        dw_thread.start()
-        dw_thread.join()  # Wait until download finishes, we don't support async downloads (yet)
-
-def make_instrument_preset_from_pack(pack_id, max_sounds_to_use=128, use_original_files=False, use_converted_files=False, include_sounds=False, max_velocity_layers=4):
-    fs_fields_param = "id,previews,license,name,username,analysis,type,filesize,tags,duration,description"
+def submit_sound_download(executor, sound, use_converted_files, processing=None, access_token=None):
+    logger.debug('{}'.format(sound['id']))
+    if sound.get('use_original', False):
+        # Original files can only be downloaded with an OAuth2 access token
+        return executor.submit(download_and_convert_sound, sound['download_url'], sound['id'], sound_type=sound['type'], access_token=access_token, convert=use_converted_files, processing=processing, original=True)
+    return executor.submit(download_and_convert_sound, sound['preview_url'], sound['id'], convert=use_converted_files, processing=processing)
+
+def download_sounds(sounds, use_converted_files, processing=None, n_workers=None, access_token=None):
+    # Downloads, conversion and processing are run in a pool of worker processes as normalisation is CPU bound
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [submit_sound_download(executor, sound, use_converted_files, processing=processing, access_token=access_token) for sound in sounds]
+        for future in futures:
+            future.result()
+
+def iter_pack_sound_pages(pack_id, use_original_files=False, use_converted_files=False, processing=None):
+    """Yields pages of prepared sounds of a pack as they are retrieved from Freesound, together with the
+    number of sounds in the pack that have not been retrieved yet. Only one page of results is kept in memory.
+    """
+    fs_fields_param = "id,previews,license,name,username,analysis,type,filesize,tags,duration,description,channels,samplerate,bitdepth"
     fs_descriptors_param = "rhythm.onset_times"
 
+    pack = freesound_client.get_pack(pack_id)
+    results = pack.get_sounds(fields=fs_fields_param, descriptors=fs_descriptors_param, page_size=150)
+    n_retrieved = 0
+    while True:
+        sounds = [prepare_sound(result, use_original=use_original_files, use_converted=use_converted_files, processing=processing) for result in results]
+        n_retrieved += len(sounds)
+        yield sounds, max(0, results.count - n_retrieved)
+        if results.next is None:
+            break
+        results = results.next_page()
+
+
+def make_instrument_preset_from_pack(pack_id, max_sounds_to_use=128, use_original_files=False, use_converted_files=False, include_sounds=False, max_velocity_layers=4, processing=None, n_workers=None, planner=None, dry_run=False, access_token=None):
     # Get sounds info
-    query_cache_filepath = f'.{pack_id}-{max_sounds_to_use}-{use_original_files}-{use_converted_files}-{include_sounds}-{max_velocity_layers}-query-cache.json'
+    query_cache_filepath = f'.{pack_id}-{max_sounds_to_use}-{use_original_files}-{use_converted_files}-{include_sounds}-{max_velocity_layers}-{processing.get_cache_key() if processing is not None else None}-query-cache.json'
     if False and os.path.exists(query_cache_filepath) and os.path.getmtime(query_cache_filepath) > time.time() - 3 * 3600:
         # If query cache exists and is not older than 3 hours, use that instead of making new query
         logger.info('- Getting pack info and preparing sounds (using cached results)')
-        sounds = json.load(open(query_cache_filepath))
+        sound_pages = iter([(json.load(open(query_cache_filepath)), 0)])
     else:
         logger.info('- Getting pack info and preparing sounds')
-        pack = freesound_client.get_pack(pack_id)
-        all_results = []
-        results = pack.get_sounds(fields=fs_fields_param, descriptors=fs_descriptors_param, page_size=150)
-        all_results += results
-        while results.next is not None:
-            results = results.next_page()
-            all_results += results 
-        sounds = [prepare_sound(result, use_original=use_original_files, use_converted=use_converted_files) for result in all_results]
-        json.dump(sounds, open(query_cache_filepath, 'w'))
-    logger.info('- Found {} sounds!'.format(len(sounds)))
-
-    # Filter out sounds that have no midi_note information
-    sounds = [sound for sound in sounds if 'midi_note' in sound]
-
-    # Download the sounds
-    if include_sounds:
+        sound_pages = iter_pack_sound_pages(pack_id, use_original_files=use_original_files, use_converted_files=use_converted_files, processing=processing)
+
+    # Select sounds while pages are retrieved and start downloading sounds as soon as they are known to be selected.
+    # When planning with budgets, sounds can't be known to be selected until all sounds are retrieved
+    selector = InstrumentSoundsSelector(max_sounds_to_use=max_sounds_to_use, max_velocity_layers=max_velocity_layers)
+    executor = None
+    download_futures = {}
+    if include_sounds and not dry_run:
         logger.info('- Downloading and converting sounds')
-        download_sounds(sounds, use_converted_files=use_converted_files)
-        
-    # Keep only as many velocity layers as indicated
-    midi_velocities = list(set([sound['midi_velocity'] for sound in sounds if 'midi_velocity' in sound]))
-    n_vel_layers_used = 1
-    if len(set(midi_velocities)) > 1:
-        # Keep the N layers with higher values
-        min_velocity_to_use = sorted(midi_velocities)[max(0, len(midi_velocities) - max_velocity_layers)]
-        n_vel_layers_used = sum([1 for vel in midi_velocities if vel >= min_velocity_to_use])
-        sounds = [sound for sound in sounds if sound['midi_velocity'] >= min_velocity_to_use or 'midi_velocity' not in sound]
-    logger.info('- Will use {} velocity layers'.format(n_vel_layers_used))
-    
-    # Remove potential midi_note/midi_velocity duplicates
-    already_used_notes = []
-    filtered_sounds = []
-    removed_notes = 0
-    for sound in sounds:
-        key = str(sound['midi_note']) + '_' + str(sound.get('midi_velocity', 0))
-        if key not in already_used_notes:
-            filtered_sounds.append(sound)
-            already_used_notes.append(key)
-        else:
-            removed_notes += 1
-    sounds = filtered_sounds
-    logger.info('- Removed {} redundant notes'.format(removed_notes))
-
-    # Keep only a specific number of notes to be below the maximum number of sounds
-    num_notes_to_keep = 0
-    for i in range(0, max_sounds_to_use, n_vel_layers_used):
-        num_notes_to_keep += 1
-    all_notes = sorted(list(set([sound['midi_note'] for sound in sounds])))
-    if num_notes_to_keep < len(all_notes):
-        n_notes_to_remove = len(all_notes) - num_notes_to_keep
-        n_sounds_to_remove = n_notes_to_remove * n_vel_layers_used
-        logger.info('- Removing {} sounds ({} notes) because exceeding max'.format(n_sounds_to_remove, n_notes_to_remove))
-        notes_to_remove = []
-        index = 0
-        while len(notes_to_remove) < n_notes_to_remove:
-            notes_to_remove.append(int(index * 127/n_notes_to_remove))
-            index += 1
-        sounds = [sound for sound in sounds if sound['midi_note'] not in notes_to_remove]
-
-    logger.info('- {} notes selected with {} velocity layers ({} sounds)'.format(num_notes_to_keep, n_vel_layers_used, len(sounds)))
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        for sounds, n_remaining in sound_pages:
+            for sound in sounds:
+                selector.add(sound)
+            if executor is not None and (planner is None or not planner.has_budget()):
+                for sound in selector.get_definitely_selected_sounds(n_remaining):
+                    if sound['id'] not in download_futures:
+                        download_futures[sound['id']] = submit_sound_download(executor, sound, use_converted_files, processing=processing, access_token=access_token)
+            logger.debug('- Retrieved {} sounds, {} candidates, {} downloads started'.format(selector.n_sounds, len(selector.candidates), len(download_futures)))
+        logger.info('- Found {} sounds!'.format(selector.n_sounds))
+        json.dump(list(selector.candidates.values()), open(query_cache_filepath, 'w'))
+
+        sounds = selector.get_selected_sounds()
+        if planner is not None:
+            sounds = planner.plan(sounds)
+            planner.log_plan(sounds, detailed=dry_run)
+
+        # Download the rest of selected sounds
+        if executor is not None:
+            for sound in sounds:
+                if sound['id'] not in download_futures:
+                    download_futures[sound['id']] = submit_sound_download(executor, sound, use_converted_files, processing=processing, access_token=access_token)
+            for future in download_futures.values():
+                future.result()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
     return sounds
 
-def make_16pad_preset_from_query(query, use_original_files=False, use_converted_files=False, include_sounds=False, max_duration=0.5):
-    fs_fields_param = "id,previews,license,name,username,analysis,type,filesize,tags,duration,description"
+def make_16pad_preset_from_query(query, use_original_files=False, use_converted_files=False, include_sounds=False, max_duration=0.5, processing=None, n_workers=None, planner=None, dry_run=False, access_token=None):
+    fs_fields_param = "id,previews,license,name,username,analysis,type,filesize,tags,duration,description,channels,samplerate,bitdepth"
     fs_descriptors_param = "rhythm.onset_times"
 
     # Search for sounds and select 16
     results = freesound_client.text_search(query=query, filter='duration:[0 TO {}]'.format(str(max_duration)), fields=fs_fields_param, descriptors=fs_descriptors_param, page_size=150)
     results_list = [r for r in results if hasattr(r, 'analysis')]
-    sounds = [prepare_sound(result, use_original=use_original_files, use_converted=use_converted_files) for result in random.sample(results_list, 16)]
+    sounds = [prepare_sound(result, use_original=use_original_files, use_converted=use_converted_files, processing=processing) for result in random.sample(results_list, 16)]
+    if planner is not None:
+        # All 16 pads are always kept, only file variants are changed to fit budgets
+        sounds = planner.plan(sounds, remove_sounds=False)
+        planner.log_plan(sounds, detailed=dry_run)
     
     # Download the sounds
-    if include_sounds:
+    if include_sounds and not dry_run:
         logger.info('- Downloading and converting sounds')
-        download_sounds(sounds, use_converted_files=use_converted_files)
+        download_sounds(sounds, use_converted_files=use_converted_files, processing=processing, n_workers=n_workers, access_token=access_token)
 
     return sounds
 
-def make_loops_preset_from_query(query, use_original_files=False, use_converted_files=False, include_sounds=False):
-    return make_16pad_preset_from_query(query, use_original_files=use_original_files, use_converted_files=use_converted_files, include_sounds=include_sounds, max_duration=10)
-
-if __name__ == '__main__':
-    parser = ArgumentParser(description="""
-    Freesound Presets. Generates sampler presets based on Freesound sounds and exports them in differen sampler formats.""")
-    parser.add_argument('-v', '--verbose', help='if set, prints detailed info on screen', action='store_const', const=True, default=False)
-    parser.add_argument('-e', '--exporter', help='one of {}'.format(str(available_exporters)), required=True)
-    parser.add_argument('-t', '--type', help='one of {}'.format(str(available_preset_types)), required=True)
-    parser.add_argument('-p', '--pack', help='Freesound pack ID to get instrument samples from', default=None)
-    parser.add_argument('-q', '--query', help='Textual query for 16pad presets', default=None)
-    parser.add_argument('-l', '--loop', help='configure sounds to loop', action='store_const', const=True, default=False)
-    parser.add_argument('-n', '--name', help='name for the output preset', required=True)
-    parser.add_argument('-i', '--include-sounds', help='include sound files with the preset', action='store_const', const=True, default=False)
-    parser.add_argument('-c', '--convert', help='convert included sound files to WAV', action='store_const', const=True, default=False)
-    parser.add_argument('-o', '--originals', help='use original sound files when downloading', action='store_const', const=True, default=False)
-    
-    args = parser.parse_args()
-    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO if not args.verbose else logging.DEBUG)
+def make_loops_preset_from_query(query, use_original_files=False, use_converted_files=False, include_sounds=False, processing=None, n_workers=None, planner=None, dry_run=False, access_token=None):
+    return make_16pad_preset_from_query(query, use_original_files=use_original_files, use_converted_files=use_converted_files, include_sounds=include_sounds, max_duration=10, processing=processing, n_workers=n_workers, planner=planner, dry_run=dry_run, access_token=access_token)
 
+def check_preset_args(args):
+    """Checks the arguments used to create a preset and returns the processing settings and maximum sound length derived from them."""
+    assert (args.exporter in available_exporters), 'Wrong exporter, must be one of {}'.format(str(available_exporters))
+    assert (args.name), 'You must provide --name parameter with the name of the preset'
     assert (args.type in available_preset_types), 'Wrong preset type, must be one of {}'.format(str(available_preset_types))
-    
+
+    assert (args.target_level is None or args.normalise is not None), 'Normalisation target level can only be used with --normalise'
+
+    processing = None
+    if args.samplerate is not None or args.bit_depth is not None or args.normalise is not None:
+        assert (args.convert), 'Resampling and normalisation can only be applied to converted sound files, use --convert'
+        processing = AudioProcessingSettings(
+            samplerate=args.samplerate or 44100, 
+            bit_depth=args.bit_depth or 16, 
+            normalisation=args.normalise, 
+            target_level=args.target_level)
+
+    max_sound_length = None
+    if args.trim:
+        assert (args.include_sounds and args.convert), 'Trimming can only be applied to included converted sound files, use --include-sounds and --convert'
+        max_sound_length = args.max_length if args.max_length is not None else max_sound_length_per_preset_type[args.type]
+        if not max_sound_length:
+            max_sound_length = None
+
+    if args.originals and (args.include_sounds or args.memory_budget is not None or args.size_budget is not None or args.dry_run):
+        assert (args.access_token), 'Downloading or planning with original files requires an OAuth2 access token, use --access-token'
+
     if args.type == 'instrument':
         assert (args.pack), 'When creating an instrument preset, you must provide --pack parameter with the pack ID'
         try:
-            pack_id = int(args.pack)
+            int(args.pack)
         except ValueError:
             raise Exception('Invalid --pack parameter, must be an integer')
+
+    return processing, max_sound_length
+
+def create_preset(args):
+    processing, max_sound_length = check_preset_args(args)
+
+    planner = SoundsBudgetPlanner(
+        memory_budget=int(args.memory_budget * 1024 * 1024) if args.memory_budget is not None else None,
+        size_budget=int(args.size_budget * 1024 * 1024) if args.size_budget is not None else None,
+        use_converted_files=args.convert,
+        processing=processing,
+        max_sound_length=max_sound_length)
+    
+    if args.type == 'instrument':
+        pack_id = int(args.pack)
         logger.info('*** Creating {} preset {}'.format(args.type, args.name))
-        sounds = make_instrument_preset_from_pack(pack_id, use_original_files=args.originals, use_converted_files=args.convert, include_sounds=args.include_sounds)
+        sounds = make_instrument_preset_from_pack(pack_id, use_original_files=args.originals, use_converted_files=args.convert, include_sounds=args.include_sounds, processing=processing, n_workers=args.workers, planner=planner, dry_run=args.dry_run, access_token=args.access_token)
 
     elif args.type == '16pad':
         logger.info('*** Creating {} preset {}'.format(args.type, args.name))
-        sounds = make_16pad_preset_from_query(args.query, use_original_files=args.originals, use_converted_files=args.convert, include_sounds=args.include_sounds)
+        sounds = make_16pad_preset_from_query(args.query, use_original_files=args.originals, use_converted_files=args.convert, include_sounds=args.include_sounds, processing=processing, n_workers=args.workers, planner=planner, dry_run=args.dry_run, access_token=args.access_token)
 
     elif args.type == 'loops':
         logger.info('*** Creating {} preset {}'.format(args.type, args.name))
-        sounds = make_loops_preset_from_query(args.query, use_original_files=args.originals, use_converted_files=args.convert, include_sounds=args.include_sounds)
+        sounds = make_loops_preset_from_query(args.query, use_original_files=args.originals, use_converted_files=args.convert, include_sounds=args.include_sounds, processing=processing, n_workers=args.workers, planner=planner, dry_run=args.dry_run, access_token=args.access_token)
+
 
+    if args.dry_run:
+        logger.info('*** Dry run, not downloading sounds nor exporting preset')
+        return
 
     if args.exporter == 'source':
         if args.loop:
@@ -302,7 +336,10 @@ if __name__ == '__main__':
             sound_overwrite_exporter_fields=sound_overwrite_exporter_fields, 
             preset_name=args.name, 
             ptype=args.type,
-            include_sounds=args.include_sounds).export()
+            include_sounds=args.include_sounds,
+            trim_silence=args.trim,
+            silence_threshold=args.silence_threshold,
+            max_sound_length=max_sound_length).export()
 
     elif args.exporter == 'blackbox':
         if args.type == 'loops':
@@ -318,4 +355,75 @@ if __name__ == '__main__':
             sound_overwrite_exporter_fields=sound_overwrite_exporter_fields, 
             preset_name=args.name, 
             ptype=args.type,
-            include_sounds=args.include_sounds).export()
+            include_sounds=args.include_sounds,
+            trim_silence=args.trim,
+            silence_threshold=args.silence_threshold,
+            max_sound_length=max_sound_length).export()
+
+def run_worker(queue, access_token=None):
+    worker_id = get_worker_id()
+    logger.info('*** Worker {} processing jobs from {}'.format(worker_id, queue.path))
+    while True:
+        job = queue.claim(worker_id)
+        if job is None:
+            break
+        job_id, job_params = job
+        logger.info('*** Worker {} running job {}'.format(worker_id, job_id))
+        try:
+            with JobLeaseRenewalThread(queue, job_id, worker_id):
+                create_preset(Namespace(access_token=access_token, **job_params))
+        except AssertionError as e:
+            # Wrong preset arguments, retrying the job would fail again
+            logger.exception('Job {} failed permanently'.format(job_id))
+            queue.fail(job_id, worker_id, str(e), retry=False)
+        except Exception as e:
+            logger.exception('Job {} failed'.format(job_id))
+            queue.fail(job_id, worker_id, str(e))
+        else:
+            queue.complete(job_id, worker_id)
+    logger.info('*** Worker {} finished, no jobs left ({})'.format(worker_id, queue.get_status_counts()))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="""
+    Freesound Presets. Generates sampler presets based on Freesound sounds and exports them in differen sampler formats.""")
+    parser.add_argument('-v', '--verbose', help='if set, prints detailed info on screen', action='store_const', const=True, default=False)
+    parser.add_argument('-e', '--exporter', help='one of {}'.format(str(available_exporters)), default=None)
+    parser.add_argument('-t', '--type', help='one of {}'.format(str(available_preset_types)), default=None)
+    parser.add_argument('-p', '--pack', help='Freesound pack ID to get instrument samples from', default=None)
+    parser.add_argument('-q', '--query', help='Textual query for 16pad presets', default=None)
+    parser.add_argument('-l', '--loop', help='configure sounds to loop', action='store_const', const=True, default=False)
+    parser.add_argument('-n', '--name', help='name for the output preset', default=None)
+    parser.add_argument('-i', '--include-sounds', help='include sound files with the preset', action='store_const', const=True, default=False)
+    parser.add_argument('-c', '--convert', help='convert included sound files to WAV', action='store_const', const=True, default=False)
+    parser.add_argument('-o', '--originals', help='use original sound files when downloading', action='store_const', const=True, default=False)
+    parser.add_argument('--access-token', help='OAuth2 access token used to download original sound files (defaults to FREESOUND_ACCESS_TOKEN environment variable)', default=os.environ.get('FREESOUND_ACCESS_TOKEN'))
+    parser.add_argument('-r', '--samplerate', help='resample converted sound files to this sample rate', type=int, default=None)
+    parser.add_argument('-b', '--bit-depth', help='bit depth of converted sound files, one of {}'.format(str(list(pcm_codecs.keys()))), type=int, default=None)
+    parser.add_argument('-g', '--normalise', help='normalise gain of converted sound files, one of {}'.format(str(AudioProcessingSettings.normalisation_modes)), default=None)
+    parser.add_argument('--target-level', help='normalisation target in dBFS (peak) or LUFS (lufs)', type=float, default=None)
+    parser.add_argument('-w', '--workers', help='number of worker processes used to download and process sounds', type=int, default=None)
+    parser.add_argument('-s', '--trim', help='trim leading and trailing silence and cap length of included sound files', action='store_const', const=True, default=False)
+    parser.add_argument('--silence-threshold', help='level in dBFS below which sound is considered silence when trimming', type=float, default=-60.0)
+    parser.add_argument('--max-length', help='maximum length in seconds of trimmed sound files (0 for no limit), defaults to {}'.format(str(max_sound_length_per_preset_type)), type=float, default=None)
+    parser.add_argument('-m', '--memory-budget', help='maximum memory (in MB) needed by the device to hold the decoded sounds of the preset', type=float, default=None)
+    parser.add_argument('--size-budget', help='maximum size (in MB) of the sound files of the preset', type=float, default=None)
+    parser.add_argument('-d', '--dry-run', help='print the planned selection of sounds without downloading sounds nor exporting the preset', action='store_const', const=True, default=False)
+    parser.add_argument('--queue', help='path of a shared job queue database (used with --enqueue and --worker)', default=None)
+    parser.add_argument('--enqueue', help='add a job to create the preset to the queue instead of creating it', action='store_const', const=True, default=False)
+    parser.add_argument('--worker', help='create presets from jobs in the queue until there are no jobs left', action='store_const', const=True, default=False)
+    
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO if not args.verbose else logging.DEBUG)
+
+    if args.enqueue or args.worker:
+        assert (args.queue), 'When using --enqueue or --worker, you must provide --queue parameter with the path of the queue database'
+        queue = JobQueue(args.queue)
+        if args.worker:
+            run_worker(queue, access_token=args.access_token)
+        else:
+            check_preset_args(args)
+            job_params = {key: value for key, value in vars(args).items() if key not in ['queue', 'enqueue', 'worker', 'access_token']}
+            job_id = queue.put(job_params)
+            logger.info('*** Added job {} to create {} preset {} to {}'.format(job_id, args.type, args.name, args.queue))
+    else:
+        create_preset(args)
@@ -2,20 +2,267 @@ import ffmpeg
 import logging
 import threading
 import os
-import urllib
+import urllib.request
 import shutil
 import errno
+import fcntl
+import json
+import socket
+import sqlite3
+import struct
+import time
 import uuid
+import wave
+
+import numpy as np
 
 logger = logging.getLogger()
 
+pcm_codecs = {16: 'pcm_s16le', 24: 'pcm_s24le', 32: 'pcm_s32le'}
+default_chunk_frames = 2 ** 16
+audio_base_path = '/app/audio'
+preview_bitrate = 192000  # Approximate bitrate (bits per second) of Freesound HQ OGG previews, used to estimate download sizes
+trim_pre_roll_seconds = 0.005
+trim_fade_out_seconds = 0.01
+
+
 def generate_uuid():
     return uuid.uuid4().hex
 
 
-def convert_to_wav(input_filename, output_filename, samplerate=44100):
+def convert_to_wav(input_filename, output_filename, samplerate=None, bit_depth=None):
+    # Without a target sample rate or bit depth, ffmpeg keeps the source sample rate and writes 16 bit PCM
     if not os.path.exists(output_filename):
-        ffmpeg.input(input_filename).output(output_filename, ac=2).run(quiet=True, overwrite_output=True)
+        output_kwargs = {'format': 'wav', 'ac': 2}
+        if samplerate is not None:
+            output_kwargs['ar'] = samplerate
+        if bit_depth is not None:
+            output_kwargs['acodec'] = pcm_codecs[bit_depth]
+        ffmpeg.input(input_filename).output(output_filename, **output_kwargs).run(quiet=True, overwrite_output=True)
+
+
+class AudioProcessingSettings(object):
+
+    normalisation_modes = ['peak', 'lufs']
+    default_target_levels = {'peak': -1.0, 'lufs': -16.0}
+
+    def __init__(self, samplerate=44100, bit_depth=16, normalisation=None, target_level=None):
+        assert (bit_depth in pcm_codecs), 'Unsupported bit depth, must be one of {}'.format(str(list(pcm_codecs.keys())))
+        assert (normalisation is None or normalisation in self.normalisation_modes), 'Unsupported normalisation mode, must be one of {}'.format(str(self.normalisation_modes))
+        self.samplerate = samplerate
+        self.bit_depth = bit_depth
+        self.normalisation = normalisation
+        if normalisation is not None and target_level is None:
+            target_level = self.default_target_levels[normalisation]
+        self.target_level = target_level
+
+    def get_cache_key(self):
+        # Name of the folder where files processed with these settings are cached (see get_sound_cache_path)
+        key = '{}_{}'.format(self.samplerate, self.bit_depth)
+        if self.normalisation is not None:
+            key += '_{}{}'.format(self.normalisation, self.target_level)
+        return key
+
+
+def read_wav_layout(filename):
+    """Parses the RIFF header of a PCM WAV file and returns its format information
+    together with the position of the sample data in the file.
+    """
+    layout = {}
+    with open(filename, 'rb') as fid:
+        riff_id, _, wave_id = struct.unpack('<4sI4s', fid.read(12))
+        if riff_id != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError('Not a WAV file: {}'.format(filename))
+        while True:
+            chunk_header = fid.read(8)
+            if len(chunk_header) < 8:
+                break
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                _, channels, samplerate, _, _, bits_per_sample = struct.unpack('<HHIIHH', fid.read(16))
+                layout['channels'] = channels
+                layout['samplerate'] = samplerate
+                layout['sample_width'] = bits_per_sample // 8
+                fid.seek(chunk_size - 16 + chunk_size % 2, 1)
+            elif chunk_id == b'data':
+                layout['data_offset'] = fid.tell()
+                # Data size might be a placeholder value if file was written to a non-seekable output
+                layout['data_size'] = min(chunk_size, os.path.getsize(filename) - layout['data_offset'])
+                break
+            else:
+                fid.seek(chunk_size + chunk_size % 2, 1)
+    if 'channels' not in layout or 'data_offset' not in layout:
+        raise ValueError('Could not find format and data chunks in WAV file: {}'.format(filename))
+    if layout['sample_width'] not in [bits // 8 for bits in pcm_codecs]:
+        raise ValueError('Unsupported WAV sample width: {}'.format(layout['sample_width']))
+    layout['frame_size'] = layout['channels'] * layout['sample_width']
+    layout['n_frames'] = layout['data_size'] // layout['frame_size']
+    return layout
+
+
+def open_wav_pcm(filename, mode='r'):
+    """Returns the layout of a WAV file and its sample data memory-mapped as raw bytes."""
+    layout = read_wav_layout(filename)
+    if layout['n_frames'] == 0:
+        return layout, np.zeros(0, dtype=np.uint8)
+    pcm = np.memmap(filename, dtype=np.uint8, mode=mode, offset=layout['data_offset'], shape=(layout['n_frames'] * layout['frame_size'],))
+    return layout, pcm
+
+
+def iter_pcm_chunks(pcm, layout, chunk_frames=default_chunk_frames):
+    chunk_size = chunk_frames * layout['frame_size']
+    for start in range(0, len(pcm), chunk_size):
+        yield start, pcm[start:start + chunk_size]
+
+
+def pcm_to_float(raw, layout):
+    """Decodes raw little-endian PCM bytes into a (frames, channels) float array in the [-1, 1) range."""
+    sample_width = layout['sample_width']
+    if sample_width == 3:
+        raw = raw.reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples = np.where(samples & 0x800000, samples - 0x1000000, samples)
+    else:
+        samples = raw.view('<i{}'.format(sample_width))
+    return (samples / float(1 << (8 * sample_width - 1))).reshape(-1, layout['channels'])
+
+
+def float_to_pcm(samples, layout):
+    """Encodes a float array in the [-1, 1) range into raw little-endian PCM bytes, clipping out of range values."""
+    sample_width = layout['sample_width']
+    full_scale = 1 << (8 * sample_width - 1)
+    samples = np.clip(np.round(samples.reshape(-1) * full_scale), -full_scale, full_scale - 1).astype('<i8')
+    if sample_width == 3:
+        return np.ascontiguousarray(samples.view(np.uint8).reshape(-1, 8)[:, :3]).reshape(-1)
+    return samples.astype('<i{}'.format(sample_width)).view(np.uint8)
+
+
+def measure_wav_levels(filename, chunk_frames=default_chunk_frames):
+    """Computes the sample peak and the integrated loudness of a WAV file in a single streaming pass.
+
+    Loudness follows the gating scheme of ITU-R BS.1770 (400ms blocks with 75% overlap, absolute
+    gate at -70 LUFS and relative gate at -10 LU) but without the K-weighting pre-filter, so values
+    are "LUFS-style" rather than exact LUFS. Sounds shorter than a single block are measured ungated.
+    """
+    layout, pcm = open_wav_pcm(filename)
+    if layout['n_frames'] == 0:
+        return 0.0, float('-inf')
+
+    # Read chunks made of whole 100ms sub-blocks, 400ms gating blocks are later built from 4 consecutive sub-blocks
+    sub_block_frames = max(1, layout['samplerate'] // 10)
+    chunk_frames = max(1, chunk_frames // sub_block_frames) * sub_block_frames
+    peak = 0.0
+    sum_squares = 0.0
+    sub_block_energies = []
+    for _, raw in iter_pcm_chunks(pcm, layout, chunk_frames):
+        samples = pcm_to_float(raw, layout)
+        peak = max(peak, float(np.abs(samples).max()))
+        squares = samples ** 2
+        sum_squares += float(squares.sum())
+        n_sub_blocks = len(squares) // sub_block_frames
+        if n_sub_blocks > 0:
+            sub_block_energies.append(squares[:n_sub_blocks * sub_block_frames].reshape(n_sub_blocks, sub_block_frames, -1).mean(axis=1).sum(axis=1))
+    del pcm
+
+    sub_block_energies = np.concatenate(sub_block_energies) if sub_block_energies else np.zeros(0)
+    if len(sub_block_energies) < 4:
+        energy = sum_squares / layout['n_frames']
+    else:
+        block_energies = np.convolve(sub_block_energies, np.ones(4) / 4, mode='valid')
+        block_energies = block_energies[block_energies > 10 ** ((-70 + 0.691) / 10)]
+        if len(block_energies) == 0:
+            return peak, float('-inf')
+        relative_gate = block_energies.mean() * 10 ** (-10 / 10)
+        energy = float(block_energies[block_energies > relative_gate].mean())
+    if energy <= 0:
+        return peak, float('-inf')
+    return peak, float(-0.691 + 10 * np.log10(energy))
+
+
+def apply_gain_to_wav(filename, gain, chunk_frames=default_chunk_frames):
+    layout, pcm = open_wav_pcm(filename, mode='r+')
+    for start, raw in iter_pcm_chunks(pcm, layout, chunk_frames):
+        pcm[start:start + len(raw)] = float_to_pcm(pcm_to_float(raw, layout) * gain, layout)
+    if len(pcm) > 0:
+        pcm.flush()
+    del pcm
+
+
+def normalise_wav(filename, normalisation, target_level, chunk_frames=default_chunk_frames):
+    peak, loudness = measure_wav_levels(filename, chunk_frames=chunk_frames)
+    if peak == 0:
+        return
+    if normalisation == 'lufs' and loudness == float('-inf'):
+        # Every block is below the absolute gate, boosting it would only amplify noise
+        return
+    if normalisation == 'peak':
+        gain = 10 ** (target_level / 20) / peak
+    else:
+        # Never push peaks above full scale to reach the loudness target
+        gain = min(10 ** ((target_level - loudness) / 20), 1 / peak)
+    logger.debug('    - Normalising {} (peak {:.2f} dBFS, loudness {:.2f} LUFS): gain {:.2f} dB'.format(filename, 20 * np.log10(peak), loudness, 20 * np.log10(gain)))
+    if abs(gain - 1) > 1e-4:
+        apply_gain_to_wav(filename, gain, chunk_frames=chunk_frames)
+
+
+def process_sound_file(input_filename, output_filename, processing):
+    convert_to_wav(input_filename, output_filename, samplerate=processing.samplerate, bit_depth=processing.bit_depth)
+    if processing.normalisation is not None:
+        normalise_wav(output_filename, processing.normalisation, processing.target_level)
+
+
+def find_wav_sound_bounds(filename, threshold_db=-60.0, chunk_frames=default_chunk_frames):
+    """Returns the layout of a WAV file and the first and last (exclusive) frames whose level is above
+    the given threshold. Leading silence is scanned forwards from the start and trailing silence
+    backwards from the end, so only the silent parts of the file (plus one chunk at each side) are read.
+    Fully silent files are not trimmed.
+    """
+    layout, pcm = open_wav_pcm(filename)
+    threshold = 10 ** (threshold_db / 20)
+    frame_size = layout['frame_size']
+    n_frames = layout['n_frames']
+
+    start_frame = None
+    for start, raw in iter_pcm_chunks(pcm, layout, chunk_frames):
+        loud_frames = np.flatnonzero(np.abs(pcm_to_float(raw, layout)).max(axis=1) > threshold)
+        if len(loud_frames) > 0:
+            start_frame = start // frame_size + int(loud_frames[0])
+            break
+    if start_frame is None:
+        return layout, 0, n_frames
+
+    end_frame = start_frame + 1
+    for chunk_end in range(n_frames, start_frame, -chunk_frames):
+        chunk_start = max(start_frame, chunk_end - chunk_frames)
+        raw = pcm[chunk_start * frame_size:chunk_end * frame_size]
+        loud_frames = np.flatnonzero(np.abs(pcm_to_float(raw, layout)).max(axis=1) > threshold)
+        if len(loud_frames) > 0:
+            end_frame = chunk_start + int(loud_frames[-1]) + 1
+            break
+    del pcm
+    return layout, start_frame, end_frame
+
+
+def write_trimmed_wav(input_filename, output_filename, start_frame, end_frame, fade_out_frames=0, chunk_frames=default_chunk_frames):
+    layout, pcm = open_wav_pcm(input_filename)
+    frame_size = layout['frame_size']
+    fade_start_frame = end_frame - fade_out_frames
+    out = wave.open(output_filename, 'wb')
+    out.setnchannels(layout['channels'])
+    out.setsampwidth(layout['sample_width'])
+    out.setframerate(layout['samplerate'])
+    for chunk_start in range(start_frame, end_frame, chunk_frames):
+        chunk_end = min(end_frame, chunk_start + chunk_frames)
+        raw = pcm[chunk_start * frame_size:chunk_end * frame_size]
+        if chunk_end > fade_start_frame:
+            # Apply a short linear fade out to avoid clicks when cutting sounds before they end
+            samples = pcm_to_float(raw, layout)
+            frame_positions = np.arange(chunk_start, chunk_end)
+            samples *= np.clip((end_frame - frame_positions) / float(max(1, fade_out_frames)), 0, 1)[:, np.newaxis]
+            raw = float_to_pcm(samples, layout)
+        out.writeframes(raw.tobytes())
+    out.close()
+    del pcm
 
 
 class SoundDownloaderProgress:
@@ -43,35 +290,304 @@ def download_sound(url, outfile, access_token=None):
             print(e)
 
 
+def get_sound_cache_path(sound_id, sound_type, convert=False, processing=None, original=False):
+    # Processed files are cached in a folder per set of processing parameters and original files in an "originals"
+    # subfolder, so that variants of the same sound never overwrite each other and file names stay as "<sound id>.<ext>"
+    path = audio_base_path
+    if convert and processing is not None:
+        path = os.path.join(path, processing.get_cache_key())
+    if original:
+        path = os.path.join(path, 'originals')
+    return os.path.join(path, '{}.{}'.format(sound_id, 'wav' if convert else sound_type))
+
+
 class DownloadAndConvertSoundsThread(threading.Thread):
 
-    def __init__(self, url, sound_id, sound_type=None, access_token=None, convert=True):
+    def __init__(self, url, sound_id, sound_type=None, access_token=None, convert=True, processing=None, original=False):
         super(DownloadAndConvertSoundsThread, self).__init__()
         self.url = url
         self.sound_id = sound_id
         self.access_token = access_token
         self.sound_type = sound_type
+        self.processing = processing
         
         if sound_type is None:
             sound_type = url.split('.')[-1]
-        self.outfile_download = os.path.join('/tmp', '{}.{}'.format(sound_id, sound_type))
-
-        if not os.path.exists('/app/audio'):
-            os.mkdir('/app/audio')
+        self.outfile_download = os.path.join('/tmp', '{}.{}.{}'.format(sound_id, generate_uuid(), sound_type))
 
         self.convert = convert
-        if convert:
-            self.outfile = '/app/audio/{}.wav'.format(sound_id)
-        else:
-            self.outfile = '/app/audio/{}.{}'.format(sound_id, sound_type)
+        self.outfile = get_sound_cache_path(sound_id, sound_type, convert=convert, processing=processing, original=original)
+        mkdir_p(os.path.dirname(self.outfile))
+
+    def is_cached(self):
+        return os.path.exists(self.outfile) and os.path.getsize(self.outfile) > 0
+
+    def get_lock_path(self):
+        return os.path.join(os.path.dirname(self.outfile), '.locks', '{}.lock'.format(os.path.basename(self.outfile)))
 
     def run(self):
-        if not (os.path.exists(self.outfile) and os.path.getsize(self.outfile) > 0):
-            download_sound(self.url, self.outfile_download, access_token=self.access_token)
-            if self.convert:
-                convert_to_wav(self.outfile_download, self.outfile)
+        if self.is_cached():
+            return
+        # Only one process (in this or in other hosts sharing the audio volume) downloads and converts each sound,
+        # others wait for the lock and then find the sound already in the cache
+        with FileLock(self.get_lock_path()):
+            if self.is_cached():
+                return
+            # Output is written to a temporary file and moved into place when complete so that
+            # other processes never see partially written files
+            tmp_outfile = '{}.{}.part'.format(self.outfile, generate_uuid())
+            try:
+                download_sound(self.url, self.outfile_download, access_token=self.access_token)
+                if self.convert:
+                    if self.processing is not None:
+                        process_sound_file(self.outfile_download, tmp_outfile, self.processing)
+                    else:
+                        convert_to_wav(self.outfile_download, tmp_outfile)
+                else:
+                    shutil.copy(self.outfile_download, tmp_outfile)
+                os.replace(tmp_outfile, self.outfile)
+            finally:
+                for filename in [tmp_outfile, self.outfile_download]:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+
+
+def download_and_convert_sound(*args, **kwargs):
+    # Entry point for running downloads in worker processes of a process pool
+    DownloadAndConvertSoundsThread(*args, **kwargs).run()
+
+
+class InstrumentSoundsSelector(object):
+    """Incrementally applies the note and velocity layer selection of instrument presets to a stream of prepared
+    sounds. Sounds without MIDI note, duplicated MIDI note/velocity pairs and sounds whose velocity can no
+    longer be among the selected velocity layers are discarded as soon as they arrive, so that the number of
+    candidates is bounded by the number of notes times the number of velocity layers (plus one for sounds
+    without velocity) regardless of the size of the pack.
+    The final selection (see get_selected_sounds) is the same as if all sounds had been retrieved at once.
+    """
+
+    def __init__(self, max_sounds_to_use=128, max_velocity_layers=4):
+        self.max_sounds_to_use = max_sounds_to_use
+        self.max_velocity_layers = max_velocity_layers
+        self.candidates = {}
+        self.used_keys = set()
+        self.midi_notes = set()
+        self.midi_velocities = set()
+        self.min_velocity_to_use = None
+        self.redundant_counts = {}
+        self.n_sounds = 0
+
+    def add(self, sound):
+        self.n_sounds += 1
+        if 'midi_note' not in sound:
+            return
+        velocity = sound.get('midi_velocity')
+        if velocity is not None:
+            self.midi_velocities.add(velocity)
+            if self.min_velocity_to_use is not None and velocity < self.min_velocity_to_use:
+                # Velocities below the N higher ones seen so far will never be selected
+                return
+        key = str(sound['midi_note']) + '_' + str(sound.get('midi_velocity', 0))
+        if key in self.used_keys:
+            self.redundant_counts[velocity] = self.redundant_counts.get(velocity, 0) + 1
+            return
+        self.used_keys.add(key)
+        self.candidates[key] = sound
+        self.midi_notes.add(sound['midi_note'])
+        if len(self.midi_velocities) > self.max_velocity_layers:
+            min_velocity_to_use = sorted(self.midi_velocities)[-self.max_velocity_layers]
+            if min_velocity_to_use != self.min_velocity_to_use:
+                self.min_velocity_to_use = min_velocity_to_use
+                self.candidates = {key: sound for key, sound in self.candidates.items() if sound.get('midi_velocity', min_velocity_to_use) >= min_velocity_to_use}
+
+    def get_n_velocity_layers_used(self, n_velocities):
+        return 1 if n_velocities <= 1 else min(self.max_velocity_layers, n_velocities)
+
+    def is_velocity_definitely_selected(self, sound, n_remaining):
+        """Returns True if the velocity of the sound will be among the selected velocity layers whatever the remaining sounds are."""
+        if 'midi_velocity' not in sound:
+            return True
+        n_higher_velocities = sum([1 for vel in self.midi_velocities if vel > sound['midi_velocity']])
+        return n_higher_velocities + min(n_remaining, 127 - sound['midi_velocity']) < self.max_velocity_layers
+
+    def get_notes_possibly_removed(self, n_remaining):
+        """Returns the MIDI notes that might be removed to keep the number of sounds below the maximum. Notes to
+        remove only depend on the number of notes to remove, so this is the union of the notes to remove for all
+        the numbers of notes to remove which are still possible given the sounds seen so far."""
+        n_velocities_seen = len(self.midi_velocities)
+        n_velocities_max = n_velocities_seen + min(n_remaining, 128 - n_velocities_seen)
+        max_num_notes_to_keep = len(range(0, self.max_sounds_to_use, self.get_n_velocity_layers_used(n_velocities_seen)))
+        min_num_notes_to_keep = len(range(0, self.max_sounds_to_use, self.get_n_velocity_layers_used(n_velocities_max)))
+        # Notes of sounds whose velocity will be selected will be part of the final notes
+        min_n_notes = len(set([sound['midi_note'] for sound in self.candidates.values() if self.is_velocity_definitely_selected(sound, n_remaining)]))
+        max_n_notes = len(self.midi_notes) + min(n_remaining, 128 - len(self.midi_notes))
+        notes = set()
+        for n_notes_to_remove in range(max(1, min_n_notes - max_num_notes_to_keep), max_n_notes - min_num_notes_to_keep + 1):
+            notes.update([int(index * 127/n_notes_to_remove) for index in range(0, n_notes_to_remove)])
+        return notes
+
+    def get_definitely_selected_sounds(self, n_remaining):
+        """Returns the sounds that will be part of the final selection whatever the remaining sounds are."""
+        notes_possibly_removed = self.get_notes_possibly_removed(n_remaining)
+        return [sound for sound in self.candidates.values() if sound['midi_note'] not in notes_possibly_removed and self.is_velocity_definitely_selected(sound, n_remaining)]
+
+    def get_selected_sounds(self):
+        sounds = list(self.candidates.values())
+
+        # Keep only as many velocity layers as indicated
+        midi_velocities = list(set([sound['midi_velocity'] for sound in sounds if 'midi_velocity' in sound]))
+        n_vel_layers_used = 1
+        min_velocity_to_use = None
+        if len(set(midi_velocities)) > 1:
+            # Keep the N layers with higher values
+            min_velocity_to_use = sorted(midi_velocities)[max(0, len(midi_velocities) - self.max_velocity_layers)]
+            n_vel_layers_used = sum([1 for vel in midi_velocities if vel >= min_velocity_to_use])
+            sounds = [sound for sound in sounds if 'midi_velocity' not in sound or sound['midi_velocity'] >= min_velocity_to_use]
+        logger.info('- Will use {} velocity layers'.format(n_vel_layers_used))
+        n_redundant = sum([count for vel, count in self.redundant_counts.items() if vel is None or min_velocity_to_use is None or vel >= min_velocity_to_use])
+        logger.info('- Removed {} redundant notes'.format(n_redundant))
+
+        # Keep only a specific number of notes to be below the maximum number of sounds
+        num_notes_to_keep = 0
+        for i in range(0, self.max_sounds_to_use, n_vel_layers_used):
+            num_notes_to_keep += 1
+        all_notes = sorted(list(set([sound['midi_note'] for sound in sounds])))
+        if num_notes_to_keep < len(all_notes):
+            n_notes_to_remove = len(all_notes) - num_notes_to_keep
+            n_sounds_to_remove = n_notes_to_remove * n_vel_layers_used
+            logger.info('- Removing {} sounds ({} notes) because exceeding max'.format(n_sounds_to_remove, n_notes_to_remove))
+            notes_to_remove = []
+            index = 0
+            while len(notes_to_remove) < n_notes_to_remove:
+                notes_to_remove.append(int(index * 127/n_notes_to_remove))
+                index += 1
+            sounds = [sound for sound in sounds if sound['midi_note'] not in notes_to_remove]
+
+        logger.info('- {} notes selected with {} velocity layers ({} sounds)'.format(num_notes_to_keep, n_vel_layers_used, len(sounds)))
+        return sounds
+
+
+class SoundsBudgetPlanner(object):
+    """Plans which sounds (and which file variants) are used in a preset so that the estimated memory needed
+    by the device to hold the decoded sounds and the size of the sound files to download/copy fit within the
+    given budgets (in bytes, None for no limit). Sounds are reduced in this order until budgets are met:
+    original files are replaced by previews (sounds which save more bytes first), lower velocity layers are
+    removed and finally notes are removed trying to keep the remaining notes evenly spread over the keyboard.
+    """
+
+    def __init__(self, memory_budget=None, size_budget=None, use_converted_files=False, processing=None, max_sound_length=None):
+        self.memory_budget = memory_budget
+        self.size_budget = size_budget
+        self.use_converted_files = use_converted_files
+        self.processing = processing
+        self.max_sound_length = max_sound_length
+
+    def has_budget(self):
+        return self.memory_budget is not None or self.size_budget is not None
+
+    def estimate_sound_sizes(self, sound):
+        """Returns the estimated size in bytes of the sound decoded as PCM and of its sound file."""
+        if self.use_converted_files:
+            if self.processing is not None:
+                samplerate = self.processing.samplerate
+            elif sound.get('use_original', False):
+                samplerate = sound.get('source_samplerate', 44100)  # Converted files keep the sample rate of the source
+            else:
+                samplerate = 44100
+            channels = 2
+            bit_depth = self.processing.bit_depth if self.processing is not None else 16
+        elif sound.get('use_original', False):
+            samplerate = sound.get('source_samplerate', 44100)
+            channels = sound.get('channels', 2)
+            bit_depth = sound.get('bitdepth') or 16  # Bit depth is 0 for compressed formats
+        else:
+            samplerate = 44100
+            channels = sound.get('channels', 2)
+            bit_depth = 16
+        # Exported sounds are shorter if their length is capped when trimming
+        duration = sound['duration'] if self.max_sound_length is None else min(sound['duration'], self.max_sound_length)
+        memory = int(duration * samplerate * channels * bit_depth / 8)
+        if self.use_converted_files:
+            size = memory + 44  # PCM data plus WAV header
+        elif sound.get('use_original', False):
+            size = sound['filesize']
+        else:
+            size = int(duration * preview_bitrate / 8)
+        return memory, size
+
+    def update_estimates(self, sound):
+        sound['estimated_memory'], sound['estimated_size'] = self.estimate_sound_sizes(sound)
+
+    def use_preview(self, sound):
+        sound['use_original'] = False
+        sound['path'] = get_sound_cache_path(sound['id'], 'ogg', convert=self.use_converted_files, processing=self.processing)
+        self.update_estimates(sound)
+
+    def get_totals(self, sounds):
+        return sum([sound['estimated_memory'] for sound in sounds]), sum([sound['estimated_size'] for sound in sounds])
+
+    def is_within_budget(self, sounds):
+        memory, size = self.get_totals(sounds)
+        return (self.memory_budget is None or memory <= self.memory_budget) and (self.size_budget is None or size <= self.size_budget)
+
+    def get_note_to_remove(self, sounds):
+        # Remove the note whose neighbours are closest, so that removing it leaves the smallest gap in the keyboard.
+        # The first and last notes are never removed while there are other notes so that the range of the keyboard is kept
+        notes = sorted(list(set([sound['midi_note'] for sound in sounds if 'midi_note' in sound])))
+        note_bytes = {note: sum([sound['estimated_memory'] + sound['estimated_size'] for sound in sounds if sound.get('midi_note') == note]) for note in notes}
+        gaps = []
+        for index, note in enumerate(notes):
+            if index == 0 or index == len(notes) - 1:
+                gap = float('inf')
             else:
-                shutil.copy(self.outfile_download, self.outfile)
+                gap = notes[index + 1] - notes[index - 1]
+            gaps.append((gap, -note_bytes[note], note))
+        return min(gaps)[-1]
+
+    def plan(self, sounds, remove_sounds=True):
+        for sound in sounds:
+            self.update_estimates(sound)
+
+        # Use previews instead of original files
+        for sound in sorted([sound for sound in sounds if sound.get('use_original', False)], key=lambda x: x['estimated_memory'] + x['estimated_size'], reverse=True):
+            if self.is_within_budget(sounds):
+                break
+            self.use_preview(sound)
+
+        if remove_sounds:
+            # Remove lower velocity layers
+            while not self.is_within_budget(sounds):
+                midi_velocities = sorted(list(set([sound['midi_velocity'] for sound in sounds if 'midi_velocity' in sound])))
+                if len(midi_velocities) <= 1:
+                    break
+                logger.info('- Removing velocity layer {} because exceeding budget'.format(midi_velocities[0]))
+                sounds = [sound for sound in sounds if sound.get('midi_velocity', midi_velocities[-1]) != midi_velocities[0]]
+
+            # Remove notes keeping as much key coverage as possible
+            removed_notes = []
+            while not self.is_within_budget(sounds) and len(set([sound.get('midi_note') for sound in sounds])) > 1:
+                note = self.get_note_to_remove(sounds)
+                removed_notes.append(note)
+                sounds = [sound for sound in sounds if sound.get('midi_note') != note]
+            if removed_notes:
+                logger.info('- Removed {} notes because exceeding budget: {}'.format(len(removed_notes), sorted(removed_notes)))
+
+        if not self.is_within_budget(sounds):
+            logger.warning('- Selected sounds do not fit within budget')
+        return sounds
+
+    def log_plan(self, sounds, detailed=False):
+        format_mb = lambda n_bytes: '{:.2f}MB'.format(n_bytes / 1024 / 1024) if n_bytes is not None else 'no limit'
+        if detailed:
+            for sound in sorted(sounds, key=lambda x: (x.get('midi_note', 0), x.get('midi_velocity', 0))):
+                logger.info('    - Sound {} (note {}, velocity {}, {}): {} in memory, {} file'.format(
+                    sound['id'], sound.get('midi_note', '-'), sound.get('midi_velocity', '-'),
+                    'original' if sound.get('use_original', False) else 'preview',
+                    format_mb(sound['estimated_memory']), format_mb(sound['estimated_size'])))
+        memory, size = self.get_totals(sounds)
+        logger.info('- Plan: {} sounds, {} notes, {} in memory (budget {}), {} of files (budget {})'.format(
+            len(sounds), len(set([sound['midi_note'] for sound in sounds if 'midi_note' in sound])),
+            format_mb(memory), format_mb(self.memory_budget), format_mb(size), format_mb(self.size_budget)))
 
 
 def mkdir_p(path):
@@ -84,18 +600,158 @@ def mkdir_p(path):
             raise
 
 
+class FileLock(object):
+    """Exclusive lock on a lock file to be used as a context manager. It uses POSIX record locks (lockf)
+    instead of flock because these are also honoured over NFS, so processes running in different hosts
+    that share the same volume are coordinated too. Locks are released by the OS if the process dies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fid = None
+
+    def __enter__(self):
+        mkdir_p(os.path.dirname(self.path))
+        self.fid = open(self.path, 'a+')
+        fcntl.lockf(self.fid, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.lockf(self.fid, fcntl.LOCK_UN)
+        self.fid.close()
+        self.fid = None
+
+
+def get_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class JobQueue(object):
+    """Job queue stored in a SQLite database so that several workers (possibly in different containers
+    sharing the same volume) can split a batch of presets. Workers claim jobs with a lease which they renew
+    while the job runs (see JobLeaseRenewalThread): if a worker dies, its job is handed to another worker once
+    the lease expires. Jobs that fail or whose lease expires are retried up to max_attempts times.
+    """
+
+    def __init__(self, path, lease_seconds=3600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            mkdir_p(os.path.dirname(path))
+        self.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT)""")
+
+    def connect(self):
+        # Transactions are handled explicitly, BEGIN IMMEDIATE takes the database write lock
+        # before reading so that two workers can never claim the same job
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def execute(self, query, params=()):
+        conn = self.connect()
+        try:
+            cursor = conn.execute(query, params)
+            return cursor.fetchall(), cursor.lastrowid
+        finally:
+            conn.close()
+
+    def put(self, params):
+        _, job_id = self.execute('INSERT INTO jobs (params) VALUES (?)', (json.dumps(params),))
+        return job_id
+
+    def claim(self, worker_id):
+        """Returns the id and params of the next available job and leases it to the worker,
+        or None if there are no jobs left."""
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            # Jobs whose lease expired too many times are considered failed
+            conn.execute('UPDATE jobs SET status = ?, error = ? WHERE status = ? AND lease_expires < ? AND attempts >= ?',
+                ('failed', 'Lease expired', 'running', now, self.max_attempts))
+            row = conn.execute('SELECT id, params FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT 1',
+                ('pending', 'running', now)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?',
+                    ('running', worker_id, now + self.lease_seconds, row[0]))
+            conn.execute('COMMIT')
+        except:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def complete(self, job_id, worker_id):
+        self.execute('UPDATE jobs SET status = ?, lease_expires = NULL WHERE id = ? AND worker = ?', ('done', job_id, worker_id))
+
+    def renew(self, job_id, worker_id):
+        self.execute('UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = ?', (time.time() + self.lease_seconds, job_id, worker_id, 'running'))
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        # Put the job back in the queue so that it is retried (e.g. after a network error) unless it already failed too many times
+        # or the error would happen again in every attempt (retry=False)
+        max_attempts = self.max_attempts if retry else 0
+        self.execute('UPDATE jobs SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, lease_expires = NULL, error = ? WHERE id = ? AND worker = ?',
+            (max_attempts, 'pending', 'failed', error, job_id, worker_id))
+
+    def get_status_counts(self):
+        rows, _ = self.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        return dict(rows)
+
+
+class JobLeaseRenewalThread(threading.Thread):
+    """Renews the lease of a job of a JobQueue periodically while the job runs, so that jobs taking longer
+    than the lease are not handed to other workers. Use it as a context manager around the job."""
+
+    def __init__(self, queue, job_id, worker_id):
+        super(JobLeaseRenewalThread, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            try:
+                self.queue.renew(self.job_id, self.worker_id)
+            except sqlite3.Error as e:
+                logger.warning('Could not renew lease of job {}: {}'.format(self.job_id, e))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.join()
+
+
 class BaseExporter(object):
 
     device_name = 'Base'
     extension = 'ext'
     supported_types = []
 
-    def __init__(self, sounds, sound_overwrite_exporter_fields=None, ptype=None, preset_number=0, preset_name="NoName", include_sounds=False):
+    def __init__(self, sounds, sound_overwrite_exporter_fields=None, ptype=None, preset_number=0, preset_name="NoName", include_sounds=False, trim_silence=False, silence_threshold=-60.0, max_sound_length=None):
         self.sounds = sounds
         self.sound_overwrite_exporter_fields = sound_overwrite_exporter_fields
         self.preset_name = preset_name
         self.preset_number = preset_number
         self.include_sounds = include_sounds
+        self.trim_silence = trim_silence
+        self.silence_threshold = silence_threshold
+        self.max_sound_length = max_sound_length
 
         if sound_overwrite_exporter_fields is not None:
             assert (len(sounds) == len(sound_overwrite_exporter_fields)), 'Number of sounds and number of overwrite fields for sounds does not match'
@@ -126,18 +782,56 @@ class BaseExporter(object):
 
     def save_sound_file(self, sound, convert_to_wav=False):
         file_path = self.get_sound_file_path(sound)
-        if not os.path.exists(file_path):
+        if 'trim_start_frame' in sound:
+            # Trimmed sounds are always rewritten as trimming settings might have changed since last export
+            mkdir_p(os.path.dirname(file_path))
+            write_trimmed_wav(sound['path'], file_path, sound['trim_start_frame'], sound['trim_end_frame'], fade_out_frames=sound['fade_out_frames'])
+        elif not os.path.exists(file_path):
             mkdir_p(os.path.dirname(file_path))
             try:
                 shutil.copy(sound['path'], file_path)
             except:
                 pass
 
+    def trim_sounds(self):
+        # Trimming is computed before generating the preset file so that sample lengths and start positions match trimmed files
+        trimmed_seconds = 0.0
+        for sound in self.sounds:
+            if not sound['path'].endswith('.wav') or not os.path.exists(sound['path']):
+                logger.debug('    - Not trimming sound {}, only converted WAV files can be trimmed'.format(sound['id']))
+                continue
+            if self.trim_silence:
+                layout, start_frame, end_frame = find_wav_sound_bounds(sound['path'], threshold_db=self.silence_threshold)
+                start_frame = max(0, start_frame - int(trim_pre_roll_seconds * layout['samplerate']))
+            else:
+                layout = read_wav_layout(sound['path'])
+                start_frame, end_frame = 0, layout['n_frames']
+            fade_out_frames = 0
+            if self.max_sound_length is not None and end_frame - start_frame > self.max_sound_length * layout['samplerate']:
+                end_frame = start_frame + int(self.max_sound_length * layout['samplerate'])
+                fade_out_frames = min(end_frame - start_frame, int(trim_fade_out_seconds * layout['samplerate']))
+            samplerate = layout['samplerate']
+            duration = (end_frame - start_frame) / samplerate
+            trimmed_seconds += layout['n_frames'] / samplerate - duration
+            sound.update({
+                'trim_start_frame': start_frame,
+                'trim_end_frame': end_frame,
+                'fade_out_frames': fade_out_frames,
+                'samplerate': samplerate,
+                'sample_length': end_frame - start_frame,
+                'duration': duration,
+                'start_time': max(0.0, sound['start_time'] - start_frame / samplerate),
+            })
+            sound['start_percentage'] = min(1.0, sound['start_time'] / duration) if duration > 0 else 0
+        logger.info('- Trimmed {:.2f} seconds of audio from exported sounds'.format(trimmed_seconds))
+
     def export(self):
         if len(self.sounds) == 0:
             logger.info('- No sounds to export...')
             return
         logger.info('- Exporting preset of {} sounds with {} exporter'.format(len(self.sounds), self.device_name))
+        if self.include_sounds and (self.trim_silence or self.max_sound_length is not None):
+            self.trim_sounds()
         file_contents = self.get_file_contents_for_device()
         
         self.save_preset_file(file_contents)
@@ -235,7 +929,7 @@ class BlackboxExporter(BaseExporter):
                     'row': count % 4,
                     'column': count // 4,
                     'filename': '.\\' + self.get_converted_sound_file_path(sound).split('/')[-1],
-                    'sample_length': int(sound['duration'] * 44100),
+                    'sample_length': sound.get('sample_length', int(sound['duration'] * sound.get('samplerate', 44100))),
                     'stype': 'sample',
                     'samtrigtype': 0,
                     'loopmode': 0,
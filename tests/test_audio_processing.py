@@ -0,0 +1,93 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from helpers import AudioProcessingSettings, convert_to_wav, float_to_pcm, measure_wav_levels, normalise_wav, process_sound_file, read_wav_layout
+
+
+class NormaliseWavTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_wav(self, samples, sample_width=2, samplerate=44100):
+        filename = os.path.join(self.tmp_dir, 'sound.wav')
+        out = wave.open(filename, 'wb')
+        out.setnchannels(samples.shape[1])
+        out.setsampwidth(sample_width)
+        out.setframerate(samplerate)
+        out.writeframes(float_to_pcm(samples, {'sample_width': sample_width, 'channels': samples.shape[1]}).tobytes())
+        out.close()
+        return filename
+
+    def test_peak_normalisation(self):
+        for sample_width in [2, 3, 4]:
+            filename = self.write_wav(0.25 * np.sin(np.linspace(0, 2000, 44100 * 2)).repeat(2).reshape(-1, 2), sample_width=sample_width)
+            normalise_wav(filename, 'peak', -1.0, chunk_frames=10000)
+            peak, _ = measure_wav_levels(filename)
+            self.assertAlmostEqual(20 * np.log10(peak), -1.0, places=2)
+
+    def test_loudness_normalisation(self):
+        filename = self.write_wav(0.25 * np.sin(np.linspace(0, 2000, 44100 * 2)).repeat(2).reshape(-1, 2))
+        normalise_wav(filename, 'lufs', -20.0)
+        _, loudness = measure_wav_levels(filename)
+        self.assertAlmostEqual(loudness, -20.0, places=1)
+
+    def test_loudness_normalisation_ignores_sounds_below_gate(self):
+        samples = 10 ** (-80 / 20) * np.random.RandomState(0).uniform(-1, 1, (44100 * 2, 2))
+        filename = self.write_wav(samples)
+        peak_before, loudness = measure_wav_levels(filename)
+        self.assertEqual(loudness, float('-inf'))
+        normalise_wav(filename, 'lufs', -16.0)
+        peak_after, _ = measure_wav_levels(filename)
+        self.assertEqual(peak_before, peak_after)
+
+
+@unittest.skipUnless(shutil.which('ffmpeg'), 'ffmpeg is not installed')
+class ConvertToWavTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # Mono 48kHz 16 bit source
+        self.source = os.path.join(self.tmp_dir, 'source.wav')
+        out = wave.open(self.source, 'wb')
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(48000)
+        out.writeframes(float_to_pcm(0.25 * np.sin(np.linspace(0, 2000, 48000)).reshape(-1, 1), {'sample_width': 2, 'channels': 1}).tobytes())
+        out.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_conversion_keeps_source_samplerate(self):
+        # Temporary files used while downloading have a ".part" extension, so format must not be guessed from it
+        filename = os.path.join(self.tmp_dir, 'sound.wav.part')
+        convert_to_wav(self.source, filename)
+        layout = read_wav_layout(filename)
+        self.assertEqual((layout['channels'], layout['samplerate'], layout['sample_width']), (2, 48000, 2))
+        self.assertEqual(layout['n_frames'], 48000)
+
+    def test_processing_resamples_and_normalises(self):
+        for bit_depth in [16, 24, 32]:
+            filename = os.path.join(self.tmp_dir, 'sound-{}.wav.part'.format(bit_depth))
+            process_sound_file(self.source, filename, AudioProcessingSettings(samplerate=22050, bit_depth=bit_depth, normalisation='peak'))
+            layout = read_wav_layout(filename)
+            self.assertEqual((layout['channels'], layout['samplerate'], layout['sample_width']), (2, 22050, bit_depth // 8))
+            self.assertAlmostEqual(layout['n_frames'], 22050, delta=64)
+            peak, _ = measure_wav_levels(filename)
+            self.assertAlmostEqual(20 * np.log10(peak), -1.0, places=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from helpers import SoundsBudgetPlanner, get_sound_cache_path, preview_bitrate
+
+
+def make_piano_sounds(duration=4.0):
+    # One preview sound for each of the 88 keys of a piano (notes 21 to 108)
+    return [{'id': note, 'midi_note': note, 'duration': duration, 'channels': 2, 'use_original': False} for note in range(21, 109)]
+
+
+class SoundsBudgetPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_keyboard_range_kept_when_removing_notes(self):
+        sound_memory = int(4.0 * 44100 * 2 * 2)
+        planner = SoundsBudgetPlanner(memory_budget=sound_memory * 30)
+        sounds = planner.plan(make_piano_sounds())
+        notes = sorted([sound['midi_note'] for sound in sounds])
+        self.assertEqual(len(notes), 30)
+        self.assertEqual(notes[0], 21)
+        self.assertEqual(notes[-1], 108)
+        self.assertTrue(max([b - a for a, b in zip(notes[:-1], notes[1:])]) <= 4)
+
+    def test_end_notes_removed_last(self):
+        planner = SoundsBudgetPlanner(memory_budget=1)
+        sounds = planner.plan(make_piano_sounds())
+        self.assertEqual(len(sounds), 1)
+        self.assertIn(sounds[0]['midi_note'], [21, 108])
+
+    def test_previews_replacing_originals_use_preview_path(self):
+        for use_converted_files in [False, True]:
+            # 96kHz original which only fits the budget when replaced by its 44.1kHz preview
+            sound = {'id': 1, 'midi_note': 60, 'duration': 4.0, 'channels': 2, 'source_samplerate': 96000, 'type': 'wav', 'filesize': 1536044, 'use_original': True}
+            sound['path'] = get_sound_cache_path(1, 'wav', convert=use_converted_files, original=True)
+            sounds = SoundsBudgetPlanner(memory_budget=10 ** 6, use_converted_files=use_converted_files).plan([sound])
+            self.assertFalse(sounds[0]['use_original'])
+            self.assertEqual(sounds[0]['path'], get_sound_cache_path(1, 'ogg', convert=use_converted_files))
+
+    def test_estimates_use_capped_sound_length(self):
+        sound = {'id': 0, 'duration': 30.0, 'channels': 2, 'use_original': False}
+        memory, size = SoundsBudgetPlanner().estimate_sound_sizes(sound)
+        capped_memory, capped_size = SoundsBudgetPlanner(max_sound_length=2.0).estimate_sound_sizes(sound)
+        self.assertEqual(memory, int(30.0 * 44100 * 2 * 2))
+        self.assertEqual(capped_memory, int(2.0 * 44100 * 2 * 2))
+        self.assertEqual(capped_size, int(2.0 * preview_bitrate / 8))
+        self.assertEqual(SoundsBudgetPlanner(max_sound_length=60.0).estimate_sound_sizes(sound), (memory, size))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import logging
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from helpers import InstrumentSoundsSelector
+
+
+def select_all_at_once(sounds, max_sounds_to_use=128, max_velocity_layers=4):
+    # Selection of instrument sounds as done before it was made incremental, used as reference
+    sounds = [sound for sound in sounds if 'midi_note' in sound]
+    midi_velocities = list(set([sound['midi_velocity'] for sound in sounds if 'midi_velocity' in sound]))
+    n_vel_layers_used = 1
+    if len(midi_velocities) > 1:
+        min_velocity_to_use = sorted(midi_velocities)[max(0, len(midi_velocities) - max_velocity_layers)]
+        n_vel_layers_used = sum([1 for vel in midi_velocities if vel >= min_velocity_to_use])
+        sounds = [sound for sound in sounds if 'midi_velocity' not in sound or sound['midi_velocity'] >= min_velocity_to_use]
+    already_used_notes = []
+    filtered_sounds = []
+    for sound in sounds:
+        key = str(sound['midi_note']) + '_' + str(sound.get('midi_velocity', 0))
+        if key not in already_used_notes:
+            filtered_sounds.append(sound)
+            already_used_notes.append(key)
+    sounds = filtered_sounds
+    num_notes_to_keep = len(range(0, max_sounds_to_use, n_vel_layers_used))
+    all_notes = sorted(list(set([sound['midi_note'] for sound in sounds])))
+    if num_notes_to_keep < len(all_notes):
+        n_notes_to_remove = len(all_notes) - num_notes_to_keep
+        notes_to_remove = [int(index * 127/n_notes_to_remove) for index in range(0, n_notes_to_remove)]
+        sounds = [sound for sound in sounds if sound['midi_note'] not in notes_to_remove]
+    return [sound['id'] for sound in sounds]
+
+
+def select_by_pages(sounds, page_size, max_sounds_to_use=128, max_velocity_layers=4):
+    # Returns the ids of the selected sounds and the ids of the sounds known to be selected after each page
+    selector = InstrumentSoundsSelector(max_sounds_to_use=max_sounds_to_use, max_velocity_layers=max_velocity_layers)
+    definitely_selected_per_page = []
+    for start in range(0, len(sounds), page_size):
+        for sound in sounds[start:start + page_size]:
+            selector.add(sound)
+        n_remaining = max(0, len(sounds) - start - page_size)
+        definitely_selected_per_page.append(set([sound['id'] for sound in selector.get_definitely_selected_sounds(n_remaining)]))
+    return [sound['id'] for sound in selector.get_selected_sounds()], definitely_selected_per_page
+
+
+class InstrumentSoundsSelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_same_selection_as_selecting_all_at_once(self):
+        for seed in range(500):
+            rnd = random.Random(seed)
+            n_notes = rnd.choice([5, 20, 40, 88, 128])
+            velocities = rnd.choice([[None], [None, 60], [30, 60, 90, 127], list(range(1, 128, 9))])
+            sounds = []
+            for sound_id in range(rnd.randint(0, 400)):
+                sound = {'id': sound_id}
+                if rnd.random() > 0.1:
+                    sound['midi_note'] = rnd.randrange(128 - n_notes, 128)
+                velocity = rnd.choice(velocities)
+                if velocity is not None:
+                    sound['midi_velocity'] = velocity
+                sounds.append(sound)
+            max_sounds_to_use = rnd.choice([16, 64, 128])
+            max_velocity_layers = rnd.choice([1, 2, 4])
+            selected, definitely_selected_per_page = select_by_pages(sounds, 37, max_sounds_to_use, max_velocity_layers)
+            self.assertEqual(selected, select_all_at_once(sounds, max_sounds_to_use, max_velocity_layers))
+            for definitely_selected in definitely_selected_per_page:
+                self.assertTrue(definitely_selected.issubset(selected))
+
+    def test_sounds_known_to_be_selected_before_last_page(self):
+        # 40 notes with 4 velocity layers in two pages of 150 and 10 sounds
+        sounds = [{'id': sound_id, 'midi_note': 40 + sound_id // 4, 'midi_velocity': [40, 80, 100, 127][sound_id % 4]} for sound_id in range(160)]
+        selected, definitely_selected_per_page = select_by_pages(sounds, 150)
+        self.assertTrue(len(definitely_selected_per_page[0]) > 0)
+        self.assertTrue(definitely_selected_per_page[0].issubset(selected))
+
+    def test_candidates_below_selected_velocities_are_discarded(self):
+        selector = InstrumentSoundsSelector(max_velocity_layers=2)
+        sound_id = 0
+        for velocity in [100, 127, 50, 10]:
+            for note in range(0, 128):
+                selector.add({'id': sound_id, 'midi_note': note, 'midi_velocity': velocity})
+                sound_id += 1
+        self.assertEqual(len(selector.candidates), 128 * 2)
+        self.assertEqual(set([sound['midi_velocity'] for sound in selector.candidates.values()]), set([100, 127]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import helpers
+from helpers import AudioProcessingSettings, JobLeaseRenewalThread, JobQueue, download_and_convert_sound, get_sound_cache_path, get_worker_id
+
+# Processes are forked so that they inherit the patched download function and audio path
+mp = multiprocessing.get_context('fork')
+
+
+def download_sound_counting(url, outfile, access_token=None):
+    # Slow download which records every call, used instead of downloading from Freesound
+    with open(os.path.join(os.path.dirname(helpers.audio_base_path), 'downloads.log'), 'a') as fid:
+        fid.write('{}\n'.format(os.getpid()))
+    time.sleep(0.2)
+    shutil.copy(url.replace('file://', ''), outfile)
+
+
+def download_in_process(url, barrier):
+    barrier.wait()
+    download_and_convert_sound(url, 1234, convert=False)
+
+
+def run_queue_worker(queue_path, claimed_path):
+    queue = JobQueue(queue_path)
+    worker_id = get_worker_id()
+    while True:
+        job = queue.claim(worker_id)
+        if job is None:
+            break
+        job_id, job_params = job
+        with open(claimed_path, 'a') as fid:
+            fid.write('{}\n'.format(job_params['n']))
+        queue.complete(job_id, worker_id)
+
+
+class SharedAudioCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.original_audio_base_path = helpers.audio_base_path
+        self.original_download_sound = helpers.download_sound
+        helpers.audio_base_path = os.path.join(self.tmp_dir, 'audio')
+        helpers.download_sound = download_sound_counting
+
+    def tearDown(self):
+        helpers.audio_base_path = self.original_audio_base_path
+        helpers.download_sound = self.original_download_sound
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sound_downloaded_once_by_concurrent_processes(self):
+        source_path = os.path.join(self.tmp_dir, 'source.ogg')
+        with open(source_path, 'wb') as fid:
+            fid.write(os.urandom(1 << 16))
+        barrier = mp.Barrier(8)
+        processes = [mp.Process(target=download_in_process, args=('file://' + source_path, barrier)) for _ in range(8)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        with open(os.path.join(self.tmp_dir, 'downloads.log')) as fid:
+            self.assertEqual(len(fid.readlines()), 1)
+        with open(source_path, 'rb') as source, open(os.path.join(helpers.audio_base_path, '1234.ogg'), 'rb') as cached:
+            self.assertEqual(source.read(), cached.read())
+        self.assertEqual([filename for filename in os.listdir(helpers.audio_base_path) if filename.endswith('.part')], [])
+
+    def test_original_and_preview_cached_separately(self):
+        preview_path = os.path.join(self.tmp_dir, 'preview.ogg')
+        original_path = os.path.join(self.tmp_dir, 'original')
+        for filename in [preview_path, original_path]:
+            with open(filename, 'wb') as fid:
+                fid.write(os.urandom(1 << 16))
+        download_and_convert_sound('file://' + preview_path, 1234, convert=False)
+        # The original is also an ogg file, so it would have the same name as the preview in the cache
+        download_and_convert_sound('file://' + original_path, 1234, sound_type='ogg', access_token='token', convert=False, original=True)
+
+        with open(os.path.join(self.tmp_dir, 'downloads.log')) as fid:
+            self.assertEqual(len(fid.readlines()), 2)
+        for source_path, original in [(preview_path, False), (original_path, True)]:
+            with open(source_path, 'rb') as source, open(get_sound_cache_path(1234, 'ogg', original=original), 'rb') as cached:
+                self.assertEqual(source.read(), cached.read())
+
+    def test_converted_variants_have_different_paths(self):
+        processing = AudioProcessingSettings(samplerate=48000)
+        paths = [get_sound_cache_path(1234, sound_type, convert=True, processing=processing, original=original) for sound_type, original in [('ogg', False), ('wav', True)]]
+        paths += [get_sound_cache_path(1234, sound_type, convert=True, original=original) for sound_type, original in [('ogg', False), ('wav', True)]]
+        self.assertEqual(len(set(paths)), 4)
+        self.assertTrue(all([os.path.basename(path) == '1234.wav' for path in paths]))
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue_path = os.path.join(self.tmp_dir, 'queue.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_jobs_split_between_concurrent_workers(self):
+        queue = JobQueue(self.queue_path)
+        for n in range(200):
+            queue.put({'n': n})
+        processes = [mp.Process(target=run_queue_worker, args=(self.queue_path, os.path.join(self.tmp_dir, 'claimed-{}'.format(i)))) for i in range(8)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        claimed = []
+        for filename in os.listdir(self.tmp_dir):
+            if filename.startswith('claimed-'):
+                with open(os.path.join(self.tmp_dir, filename)) as fid:
+                    claimed += [int(line) for line in fid.readlines()]
+        self.assertEqual(sorted(claimed), list(range(200)))
+        self.assertEqual(queue.get_status_counts(), {'done': 200})
+
+    def test_failed_jobs_are_retried(self):
+        queue = JobQueue(self.queue_path, max_attempts=2)
+        queue.put({'n': 0})
+        job_id, _ = queue.claim('worker-1')
+        queue.fail(job_id, 'worker-1', 'Network error')
+        self.assertEqual(queue.get_status_counts(), {'pending': 1})
+        job_id, _ = queue.claim('worker-2')
+        queue.fail(job_id, 'worker-2', 'Network error')
+        self.assertEqual(queue.get_status_counts(), {'failed': 1})
+        self.assertIsNone(queue.claim('worker-3'))
+
+    def test_permanent_failures_are_not_retried(self):
+        queue = JobQueue(self.queue_path, max_attempts=3)
+        queue.put({'n': 0})
+        job_id, _ = queue.claim('worker-1')
+        queue.fail(job_id, 'worker-1', 'Wrong preset type', retry=False)
+        self.assertEqual(queue.get_status_counts(), {'failed': 1})
+        self.assertIsNone(queue.claim('worker-2'))
+
+    def test_lease_renewed_while_job_runs(self):
+        queue = JobQueue(self.queue_path, lease_seconds=0.3)
+        queue.put({'n': 0})
+        job_id, _ = queue.claim('worker-1')
+        with JobLeaseRenewalThread(queue, job_id, 'worker-1'):
+            time.sleep(0.6)
+            self.assertIsNone(queue.claim('worker-2'))
+        time.sleep(0.4)
+        self.assertEqual(queue.claim('worker-2')[0], job_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
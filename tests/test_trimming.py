@@ -0,0 +1,117 @@
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from helpers import BlackboxExporter, find_wav_sound_bounds, float_to_pcm, open_wav_pcm, pcm_to_float, trim_fade_out_seconds, trim_pre_roll_seconds, write_trimmed_wav
+
+
+def make_tone(n_frames, amplitude=0.5):
+    # Square wave at the Nyquist frequency so that every frame of the tone is above the silence threshold
+    return amplitude * np.where(np.arange(n_frames) % 2, -1.0, 1.0).repeat(2).reshape(-1, 2)
+
+
+def read_wav_samples(filename):
+    layout, pcm = open_wav_pcm(filename)
+    return layout, pcm_to_float(np.array(pcm), layout)
+
+
+class TmpBlackboxExporter(BlackboxExporter):
+
+    def __init__(self, base_path, *args, **kwargs):
+        super(TmpBlackboxExporter, self).__init__(*args, **kwargs)
+        self.base_path = base_path
+
+    def get_base_path(self):
+        return self.base_path
+
+
+class TrimSilenceTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tmp_dir)
+
+    def write_wav(self, samples, name='sound.wav', sample_width=2, samplerate=44100):
+        filename = os.path.join(self.tmp_dir, name)
+        out = wave.open(filename, 'wb')
+        out.setnchannels(samples.shape[1])
+        out.setsampwidth(sample_width)
+        out.setframerate(samplerate)
+        out.writeframes(float_to_pcm(samples, {'sample_width': sample_width, 'channels': samples.shape[1]}).tobytes())
+        out.close()
+        return filename
+
+    def test_silence_bounds(self):
+        silence = np.zeros((22050, 2))
+        for sample_width in [2, 3, 4]:
+            filename = self.write_wav(np.concatenate([silence, make_tone(30000), silence]), sample_width=sample_width)
+            layout, start_frame, end_frame = find_wav_sound_bounds(filename, chunk_frames=4096)
+            self.assertEqual(layout['sample_width'], sample_width)
+            self.assertEqual((start_frame, end_frame), (22050, 22050 + 30000))
+
+            trimmed_filename = os.path.join(self.tmp_dir, 'trimmed.wav')
+            write_trimmed_wav(filename, trimmed_filename, start_frame, end_frame, chunk_frames=4096)
+            trimmed_layout, samples = read_wav_samples(trimmed_filename)
+            self.assertEqual(trimmed_layout['sample_width'], sample_width)
+            self.assertEqual(trimmed_layout['n_frames'], 30000)
+            self.assertTrue(np.allclose(samples, make_tone(30000), atol=1e-4))
+
+    def test_silent_file_not_trimmed(self):
+        filename = self.write_wav(np.zeros((44100, 2)))
+        layout, start_frame, end_frame = find_wav_sound_bounds(filename, chunk_frames=4096)
+        self.assertEqual((start_frame, end_frame), (0, 44100))
+
+        trimmed_filename = os.path.join(self.tmp_dir, 'trimmed.wav')
+        write_trimmed_wav(filename, trimmed_filename, start_frame, end_frame, chunk_frames=4096)
+        with open(filename, 'rb') as source, open(trimmed_filename, 'rb') as trimmed:
+            self.assertEqual(source.read(), trimmed.read())
+
+    def test_length_cap_fades_out(self):
+        filename = self.write_wav(make_tone(88200))
+        fade_out_frames = int(trim_fade_out_seconds * 44100)
+        trimmed_filename = os.path.join(self.tmp_dir, 'trimmed.wav')
+        write_trimmed_wav(filename, trimmed_filename, 0, 44100, fade_out_frames=fade_out_frames, chunk_frames=4096)
+        layout, samples = read_wav_samples(trimmed_filename)
+        self.assertEqual(layout['n_frames'], 44100)
+        self.assertTrue(np.allclose(samples[:44100 - fade_out_frames], make_tone(44100 - fade_out_frames), atol=1e-4))
+        gains = np.abs(samples[44100 - fade_out_frames:, 0]) / 0.5
+        self.assertTrue(np.allclose(gains, np.arange(fade_out_frames, 0, -1) / fade_out_frames, atol=1e-3))
+
+    def test_exported_sounds_match_trimmed_files(self):
+        sounds = []
+        for n in range(16):
+            # 0.5 seconds of silence, 2 seconds of tone and 0.5 seconds of silence, onset detected after the silence
+            filename = self.write_wav(np.concatenate([np.zeros((22050, 2)), make_tone(88200), np.zeros((22050, 2))]), name='{}.wav'.format(n))
+            sounds.append({'id': n, 'path': filename, 'duration': 3.0, 'start_time': 0.6, 'start_percentage': 0.2})
+        exporter = TmpBlackboxExporter(os.path.join(self.tmp_dir, 'preset'), sounds, ptype='16pad', include_sounds=True, trim_silence=True, max_sound_length=1.0)
+        exporter.export()
+
+        start_frame = 22050 - int(trim_pre_roll_seconds * 44100)
+        for sound in sounds:
+            self.assertEqual(sound['trim_start_frame'], start_frame)
+            self.assertEqual(sound['sample_length'], 44100)
+            self.assertAlmostEqual(sound['duration'], 1.0)
+            self.assertAlmostEqual(sound['start_time'], 0.6 - start_frame / 44100.0)
+            self.assertAlmostEqual(sound['start_percentage'], sound['start_time'] / sound['duration'])
+            layout, _ = read_wav_samples(exporter.get_sound_file_path(sound))
+            self.assertEqual(layout['n_frames'], sound['sample_length'])
+
+        with open(exporter.get_preset_file_path()) as fid:
+            self.assertEqual(re.findall(r'samlen="(\d+)"', fid.read()), ['44100'] * 16)
+
+
+if __name__ == '__main__':
+    unittest.main()